@@ -1,8 +1,8 @@
-import asyncio
 import logging
 from datetime import datetime
 from pathlib import Path
 
+from utils.aio import run
 from processors import (
     md2html_main,
     html2img_main,
@@ -26,7 +26,7 @@ async def main():
 
         # 4. Markdown转音频
         logger.info("开始执行Markdown到音频的转换...")
-        md2audio_main("audioText.md")  # 这个函数不是异步的
+        await md2audio_main("audioText.md")
         logger.info("Markdown到音频转换完成")
 
         # 1. Markdown转HTML
@@ -55,4 +55,4 @@ if __name__ == "__main__":
     Path("logs").mkdir(exist_ok=True)
     
     # 运行主程序
-    asyncio.run(main()) 
\ No newline at end of file
+    run(main()) 
\ No newline at end of file
@@ -1,8 +1,12 @@
 import asyncio
 import argparse
+import atexit
+import base64
 import sys
 import os
 import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing.util import Finalize
 from pathlib import Path
 from PIL import Image, ImageChops
 from datetime import datetime
@@ -16,9 +20,8 @@ try:
     import selenium
     from selenium import webdriver
     from selenium.webdriver.chrome.options import Options
-    from selenium.webdriver.chrome.service import Service
     from selenium.webdriver.support.ui import WebDriverWait
-    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.common.exceptions import TimeoutException
 except ImportError:
     print("错误: 请先安装 selenium 库 (pip install selenium)")
     sys.exit(1)
@@ -48,47 +51,122 @@ async def read_file_content(file_path):
     except Exception as e:
         raise IOError(f"无法读取文件 {file_path}: {e}")
 
-async def html_to_image(html_file, output_name, width=1920, height=1080):
-    """将HTML文件转换为图片"""
-    output_dir = get_output_dir("images")
-    output_image = output_dir / f"{output_name}.png"
+# 工作进程内持久复用的浏览器实例
+_worker_driver = None
 
-    
-    # 设置Chrome选项
+def _build_chrome_options(width, height):
+    """构建截图用的Chrome选项"""
     chrome_options = Options()
-    chrome_options.add_argument("--headless")  # 无头模式
-    chrome_options.add_argument("--disable-gpu")
+    chrome_options.add_argument("--headless=new")  # 无头模式
     chrome_options.add_argument(f"--window-size={width},{height}")
     chrome_options.add_argument("--hide-scrollbars")
-    
-    # 创建Chrome浏览器实例
-    driver = webdriver.Chrome(options=chrome_options)
-    
+    # 页面会加载远程图片和样式，只在root下运行（Chrome拒绝以root身份启用沙箱）时才关闭沙箱
+    if hasattr(os, "geteuid") and os.geteuid() == 0:
+        chrome_options.add_argument("--no-sandbox")
+    # 只需要渲染本地页面，关闭扩展、后台网络等用不到的功能
+    chrome_options.add_argument("--disable-extensions")
+    chrome_options.add_argument("--disable-dev-shm-usage")
+    chrome_options.add_argument("--disable-background-networking")
+    chrome_options.add_argument("--disable-sync")
+    chrome_options.add_argument("--disable-default-apps")
+    chrome_options.add_argument("--disable-features=TranslateUI,BlinkGenPropertyTrees")
+    # DOM就绪即返回，截图前再等待页面完全加载
+    chrome_options.page_load_strategy = "eager"
+    return chrome_options
+
+def _init_worker_driver(width=1920, height=1080):
+    """初始化当前进程的浏览器实例，之后的截图任务都复用它"""
+    global _worker_driver
+    _worker_driver = webdriver.Chrome(options=_build_chrome_options(width, height))
+    # multiprocessing子进程退出时不会执行atexit回调，改用Finalize关闭浏览器
+    Finalize(None, _quit_worker_driver, exitpriority=10)
+    atexit.register(_quit_worker_driver)
+
+def _quit_worker_driver():
+    """关闭当前进程的浏览器实例"""
+    global _worker_driver
+    if _worker_driver is not None:
+        try:
+            _worker_driver.quit()
+        except Exception as e:
+            logger.warning(f"关闭浏览器时出错: {e}")
+        _worker_driver = None
+
+def screenshot_html(html_path, output_path, width=1920, height=1080):
+    """在当前进程的浏览器中加载HTML文件并截图"""
+    if _worker_driver is None:
+        _init_worker_driver(width, height)
+    driver = _worker_driver
     try:
         # 获取HTML文件的绝对路径
-        html_path = os.path.abspath(html_file)
-        file_url = f"file:///{html_path}"
-        
+        file_url = f"file:///{os.path.abspath(html_path)}"
+
         # 加载HTML文件
         driver.get(file_url)
-        
-        # 等待页面加载完成
-        import time
-        time.sleep(1)  # 简单等待，确保页面完全渲染
-        
-        # 截图
-        driver.save_screenshot(str(output_image))
-        logger.info(f"已保存截图到 {output_image}")
-        
+
+        # 等待页面加载完成，而不是固定等待；远程图片、字体加载过慢时也照常截图
+        try:
+            WebDriverWait(driver, 3).until(
+                lambda d: d.execute_script("return document.readyState") == "complete")
+        except TimeoutException:
+            logger.warning(f"页面 {html_path} 未在3秒内加载完成，直接截图")
+
+        # 通过DevTools协议直接截图，省去Selenium的文件中转
+        result = driver.execute_cdp_cmd("Page.captureScreenshot", {"format": "png"})
+        Path(output_path).write_bytes(base64.b64decode(result["data"]))
+        logger.info(f"已保存截图到 {output_path}")
+
         return True
     except Exception as e:
-        print(f"截图过程中出错: {e}")
+        logger.error(f"截图过程中出错: {e}")
         return False
+
+def _run_screenshot_jobs(tasks, width, height, max_workers):
+    """将 (html_file, output_image) 任务分发到多个工作进程，返回成功数量"""
+    success_count = 0
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker_driver,
+                             initargs=(width, height)) as executor:
+        futures = {executor.submit(screenshot_html, html_file, output_image, width, height): html_file
+                   for html_file, output_image in tasks}
+        for future in as_completed(futures):
+            html_file = futures[future]
+            try:
+                success = future.result()
+            except Exception as e:
+                logger.error(f"处理 {html_file.name} 时出错: {e}")
+                continue
+            if success:
+                success_count += 1
+                logger.info(f"成功处理 {html_file.name}")
+            else:
+                logger.error(f"处理失败 {html_file.name}")
+    return success_count
+
+def _news_sort_key(stem):
+    """news_<序号> 按序号排序，其他文件名（包括序号不是数字的）排在最后"""
+    if stem.startswith('news_'):
+        number = stem.split('_')[1]
+        if number.isdigit():
+            return int(number)
+    return float('inf')
+
+def sort_news_files(files):
+    """按新闻序号排序文件列表，每个文件名只解析一次"""
+    keyed = [(_news_sort_key(f.stem), f.name, f) for f in files]
+    keyed.sort()  # 文件名唯一，不会比较到Path对象本身
+    return [f for _, _, f in keyed]
+
+async def html_to_image(html_file, output_name, width=1920, height=1080):
+    """将HTML文件转换为图片"""
+    output_dir = get_output_dir("images")
+    output_image = output_dir / f"{output_name}.png"
+
+    try:
+        return await asyncio.to_thread(screenshot_html, html_file, output_image, width, height)
     finally:
-        # 关闭浏览器
-        driver.quit()
+        _quit_worker_driver()
 
-async def process_html_directory(html_dir, width=1920, height=1080):
+async def process_html_directory(html_dir, width=1920, height=1080, workers=None):
     """处理HTML目录下的所有文件"""
     html_path = Path(html_dir)
     if not html_path.exists():
@@ -96,22 +174,16 @@ async def process_html_directory(html_dir, width=1920, height=1080):
     
     # 获取所有HTML文件（除了index.html）
     html_files = [f for f in html_path.glob("*.html") if f.name != "index.html"]
-    html_files.sort(key=lambda x: int(x.stem.split('_')[1]) if x.stem.startswith('news_') else float('inf'))
+    html_files = sort_news_files(html_files)
+    if not html_files:
+        return 0
     
-    success_count = 0
-    for html_file in html_files:
-        output_name = html_file.stem
-        try:
-            success = await html_to_image(html_file, output_name, width, height)
-            if success:
-                success_count += 1
-                logger.info(f"成功处理 {html_file.name}")
-            else:
-                logger.error(f"处理失败 {html_file.name}")
-        except Exception as e:
-            logger.error(f"处理 {html_file.name} 时出错: {e}")
+    # 每个工作进程持有一个浏览器，进程数不超过文件数
+    max_workers = min(workers or os.cpu_count() or 1, len(html_files))
+    output_dir = get_output_dir("images")
+    tasks = [(html_file, output_dir / f"{html_file.stem}.png") for html_file in html_files]
     
-    return success_count
+    return await asyncio.to_thread(_run_screenshot_jobs, tasks, width, height, max_workers)
 
 async def main():
     parser = argparse.ArgumentParser(
@@ -131,6 +203,8 @@ async def main():
                       help="截图宽度，默认1920像素")
     parser.add_argument("--height", "-ht", type=int, default=1080,
                       help="截图高度，默认1080像素")
+    parser.add_argument("--workers", "-j", type=int, default=None,
+                      help="并行的浏览器进程数量，默认为CPU核心数")
     
     args = parser.parse_args()
     
@@ -165,7 +239,7 @@ async def main():
                 raise FileNotFoundError(f"HTML目录不存在: {html_dir}")
             
             logger.info(f"处理目录: {html_dir}")
-            success_count = await process_html_directory(html_dir, args.width, args.height)
+            success_count = await process_html_directory(html_dir, args.width, args.height, args.workers)
             logger.info(f"成功处理 {success_count} 个HTML文件")
             
     except Exception as e:
@@ -1,11 +1,17 @@
 """Convert images to video with timeline support."""
+import asyncio
+import functools
 import json
+import os
 import subprocess
 import tempfile
 import sys
 import logging
 from pathlib import Path
 from datetime import timedelta, datetime
+from mutagen import MutagenError
+from mutagen.mp3 import MP3
+from dotenv import load_dotenv
 
 # 添加项目根目录到Python路径
 project_root = Path(__file__).parent.parent
@@ -13,6 +19,9 @@ sys.path.append(str(project_root))
 # 导入公共模块
 from utils.paths import get_output_dir
 
+# 加载环境变量
+load_dotenv()
+
 # 确保logs目录存在
 Path("logs").mkdir(exist_ok=True)
 
@@ -27,11 +36,13 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# 音频目录 -> 音频文件 的查找缓存
+_audio_file_cache = {}
+
 def time_str_to_seconds(time_str):
     """将字幕格式的时间字符串 (HH:MM:SS,mmm) 转换为秒数"""
-    time_str = time_str.replace(',', '.')
-    hours, minutes, seconds = time_str.split(':')
-    return float(hours) * 3600 + float(minutes) * 60 + float(seconds)
+    hours, minutes, seconds = time_str.replace(',', '.').split(':')
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
 
 def find_audio_file(audio_dir):
     """查找目录中唯一的MP3文件"""
@@ -40,25 +51,124 @@ def find_audio_file(audio_dir):
         logger.error(f"音频目录不存在: {audio_dir}")
         return None
     
+    cache_key = audio_path.resolve()
+    cached = _audio_file_cache.get(cache_key)
+    if cached is not None and cached.exists():
+        return cached
+    
     mp3_files = list(audio_path.glob("*.mp3"))
     if not mp3_files:
         logger.error(f"在目录 {audio_dir} 中未找到MP3文件")
         return None
     
     logger.info(f"找到音频文件: {mp3_files[0]}")
+    _audio_file_cache[cache_key] = mp3_files[0]
     return mp3_files[0]
 
+@functools.lru_cache(maxsize=64)
+def _probe_audio_duration(audio_file):
+    """读取音频时长（秒），优先解析MP3文件头，失败时回退到ffprobe"""
+    try:
+        return MP3(audio_file).info.length
+    except MutagenError:
+        cmd = ['ffprobe', '-v', 'quiet', '-show_entries', 'format=duration', 
+               '-of', 'default=noprint_wrappers=1:nokey=1', audio_file]
+        result = subprocess.run(cmd, capture_output=True, text=True)
+        return float(result.stdout.strip())
+
 def get_audio_duration(audio_file):
     """获取音频文件的时长（秒）"""
-    cmd = ['ffprobe', '-v', 'quiet', '-show_entries', 'format=duration', 
-           '-of', 'default=noprint_wrappers=1:nokey=1', str(audio_file)]
-    result = subprocess.run(cmd, capture_output=True, text=True)
-    return float(result.stdout.strip())
+    return _probe_audio_duration(str(audio_file))
+
+@functools.lru_cache(maxsize=1)
+def _nvenc_available():
+    """检测NVENC硬件编码是否真正可用（结果缓存，只探测一次）
+
+    编码器列表里有h264_nvenc只说明ffmpeg编译时带了它，不代表有NVIDIA显卡和驱动，
+    所以实际编码一帧来确认。
+    """
+    cmd = ['ffmpeg', '-hide_banner', '-v', 'error',
+           '-f', 'lavfi', '-i', 'color=s=256x256',
+           '-frames:v', '1', '-c:v', 'h264_nvenc', '-f', 'null', '-']
+    try:
+        subprocess.run(cmd, capture_output=True, check=True, timeout=30)
+    except (OSError, subprocess.SubprocessError) as e:
+        logger.info(f"NVENC硬件编码不可用，使用libx264: {e}")
+        return False
+    return True
+
+@functools.lru_cache(maxsize=1)
+def _cuda_pipeline_available():
+    """检测CUDA上传和缩放滤镜能否配合NVENC使用（结果缓存，只探测一次）"""
+    if not _nvenc_available():
+        return False
+    cmd = ['ffmpeg', '-hide_banner', '-v', 'error',
+           '-hwaccel', 'cuda', '-hwaccel_output_format', 'cuda',
+           '-f', 'lavfi', '-i', 'color=s=256x256',
+           '-vf', 'format=nv12,hwupload_cuda,scale_cuda=256:-2',
+           '-frames:v', '1', '-c:v', 'h264_nvenc', '-f', 'null', '-']
+    try:
+        subprocess.run(cmd, capture_output=True, check=True, timeout=30)
+    except (OSError, subprocess.SubprocessError) as e:
+        logger.info(f"CUDA滤镜不可用，改为CPU缩放: {e}")
+        return False
+    return True
+
+def get_video_encoder_args(fps=None):
+    """获取视频编码参数，优先使用NVENC，不可用时回退到libx264"""
+    # 低帧率输出时每秒一个关键帧，保证拖动进度条时的定位精度
+    gop_args = ['-g', str(max(1, round(fps)))] if fps else []
+    if _nvenc_available():
+        logger.info("使用NVENC硬件编码")
+        return ['-c:v', 'h264_nvenc', '-preset', 'p4', '-tune', 'll',
+                '-rc', 'vbr', '-cq', '23', '-b:v', '0', '-bf', '0'] + gop_args
+    return ['-c:v', 'libx264', '-preset', 'ultrafast', '-tune', 'stillimage', '-crf', '28'] + gop_args
+
+def get_video_input_args():
+    """获取图片输入的硬件加速参数，CUDA链路可用时使用CUDA"""
+    if _cuda_pipeline_available():
+        return ['-hwaccel', 'cuda', '-hwaccel_output_format', 'cuda']
+    return []
+
+def get_video_filter(fps=None):
+    """获取视频滤镜，CUDA链路可用时上传到GPU后再缩放，帧数据全程留在显存中"""
+    fps_filter = f'fps={fps},' if fps else ''
+    if _cuda_pipeline_available():
+        return f'{fps_filter}format=nv12,hwupload_cuda,scale_cuda=1920:-2'
+    return f'{fps_filter}format=yuv420p,scale=1920:-2'
+
+def get_video_fps(default=2):
+    """读取环境变量VIDEO_FPS指定的输出帧率，设为0时改为可变帧率（返回None）"""
+    value = os.getenv('VIDEO_FPS')
+    if not value:
+        return default
+    try:
+        fps = float(value)
+    except ValueError:
+        logger.warning(f"VIDEO_FPS={value} 不是有效的数字，使用默认帧率 {default}")
+        return default
+    if fps <= 0:
+        return None
+    return int(fps) if fps.is_integer() else fps
+
+async def run_command(cmd):
+    """异步执行外部命令，返回标准输出；命令失败时抛出RuntimeError"""
+    proc = await asyncio.create_subprocess_exec(
+        *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    stdout, stderr = await proc.communicate()
+    if proc.returncode:
+        raise RuntimeError(f"命令执行失败 (返回码 {proc.returncode}): {' '.join(cmd)}\n"
+                           f"{stderr.decode('utf-8', errors='replace').strip()}")
+    return stdout
 
-def create_news_video(json_path, images_dir, output_name, output_dir, audio_dir="audio"):
-    """创建新闻视频"""
+async def create_news_video(json_path, images_dir, output_name, output_dir, audio_dir="audio", fps=2):
+    """创建新闻视频
+    
+    静态幻灯片默认以2fps的恒定帧率输出，编码帧数远少于常规帧率；
+    fps为None时改为可变帧率，只在画面切换时输出帧。
+    下游播放器或平台不接受低帧率时，可通过环境变量VIDEO_FPS调整。
+    """
     output_path = output_dir / f"video_{output_name}.mp4"
-    temp_output = output_dir / f"temp_{output_name}.mp4"
     
     # 读取JSON文件
     with open(json_path, 'r', encoding='utf-8') as f:
@@ -67,81 +177,73 @@ def create_news_video(json_path, images_dir, output_name, output_dir, audio_dir=
     news_count = len(data['timeline'])
     logger.info(f"开始处理 {news_count} 条新闻")
 
+    # 图片目录只解析一次，配置内容先在内存中拼好再一次性写入
+    images_abs = Path(images_dir).resolve()
+    lines = []
+    total_duration = 0
+    for i, news in enumerate(data['timeline']):
+        image_path = images_abs / f"news_{i+1}.png"
+        
+        start_seconds = time_str_to_seconds(news['start_seconds'])
+        end_seconds = time_str_to_seconds(news['end_seconds'])
+        duration = end_seconds - start_seconds
+        total_duration = max(total_duration, end_seconds)
+        
+        logger.debug(f"处理图片: {image_path}, 持续时间: {duration:.2f}秒")
+        
+        if image_path.exists():
+            lines.append(f"file '{image_path}'\n")
+            lines.append(f"duration {duration}\n")
+        else:
+            logger.warning(f"找不到图片 {image_path}")
+            continue
+    
+    if news_count > 0:
+        last_image = images_abs / f"news_{news_count}.png"
+        lines.append(f"file '{last_image}'\n")
+
     # 创建临时文件存储ffmpeg配置
     with tempfile.NamedTemporaryFile(mode='w', suffix='.txt', delete=False) as temp_file:
-        total_duration = 0
-        for i in range(news_count):
-            news = data['timeline'][i]
-            image_path = Path(images_dir) / f"news_{i+1}.png"
-            
-            start_seconds = time_str_to_seconds(news['start_seconds'])
-            end_seconds = time_str_to_seconds(news['end_seconds'])
-            duration = end_seconds - start_seconds
-            total_duration = max(total_duration, end_seconds)
-            
-            logger.debug(f"处理图片: {image_path}, 持续时间: {duration:.2f}秒")
-            
-            if image_path.exists():
-                temp_file.write(f"file '{image_path.absolute()}'\n")
-                temp_file.write(f"duration {duration}\n")
-            else:
-                logger.warning(f"找不到图片 {image_path}")
-                continue
-        
-        if news_count > 0:
-            last_image = Path(images_dir) / f"news_{news_count}.png"
-            temp_file.write(f"file '{last_image.absolute()}'\n")
+        temp_file.write("".join(lines))
 
-    # 构建ffmpeg命令 (对临时文件)
-    ffmpeg_cmd = [
-        'ffmpeg', '-y', '-f', 'concat', '-safe', '0', '-i', temp_file.name
-    ]
+    # 硬件编码探测会同步运行ffmpeg，先在工作线程中完成（结果已缓存），下面构建命令时不再阻塞事件循环
+    await asyncio.to_thread(_cuda_pipeline_available)
+
+    # 构建ffmpeg命令
+    ffmpeg_cmd = ['ffmpeg', '-y']
+    ffmpeg_cmd.extend(get_video_input_args())
+    ffmpeg_cmd.extend(['-f', 'concat', '-safe', '0', '-i', temp_file.name])
     
     # 添加音频
     audio_file = find_audio_file(audio_dir)
     if audio_file:
-        ffmpeg_cmd.extend([
-            '-i', str(audio_file), '-c:v', 'libx264', '-preset', 'ultrafast',
-            '-tune', 'stillimage', '-crf', '28', '-c:a', 'aac', '-b:a', '128k',
-            '-shortest', '-vf', 'format=yuv420p,scale=1920:-2'
-        ])
-    else:
-        ffmpeg_cmd.extend([
-            '-c:v', 'libx264', '-preset', 'ultrafast', '-tune', 'stillimage',
-            '-crf', '28', '-vf', 'format=yuv420p,scale=1920:-2'
-        ])
+        ffmpeg_cmd.extend(['-i', str(audio_file)])
+    
+    # 静态图片幻灯片，使用低帧率（或可变帧率）减少编码量
+    ffmpeg_cmd.extend(['-vsync', 'cfr' if fps else 'vfr'])
+    ffmpeg_cmd.extend(get_video_encoder_args(fps))
+    if audio_file:
+        ffmpeg_cmd.extend(['-c:a', 'aac', '-b:a', '128k', '-shortest'])
+    ffmpeg_cmd.extend(['-vf', get_video_filter(fps)])
     
-    ffmpeg_cmd.extend(['-threads', '0', str(temp_output)])
+    # 根据时间轴直接裁剪掉最后8秒，无需二次转码
+    ffmpeg_cmd.extend([
+        '-t', str(max(0, total_duration - 8)),  # 确保不会出现负数持续时间
+        '-threads', '0', str(output_path)
+    ])
 
     try:
-        logger.info("开始生成临时视频...")
-        subprocess.run(ffmpeg_cmd, check=True)
-        
-        # 获取视频时长
-        probe_cmd = ['ffprobe', '-v', 'quiet', '-show_entries', 'format=duration',
-                    '-of', 'default=noprint_wrappers=1:nokey=1', str(temp_output)]
-        result = subprocess.run(probe_cmd, capture_output=True, text=True, check=True)
-        duration = float(result.stdout.strip())
-        
-        # 裁剪掉最后8秒
-        trim_cmd = [
-            'ffmpeg', '-y', '-i', str(temp_output),
-            '-t', str(max(0, duration - 8)),  # 确保不会出现负数持续时间
-            '-c', 'copy', str(output_path)
-        ]
-        
-        logger.info("开始裁剪视频...")
-        subprocess.run(trim_cmd, check=True)
+        logger.info("开始生成视频...")
+        await run_command(ffmpeg_cmd)
         
         logger.info(f"视频生成成功: {output_path}")
         return True
-    except subprocess.CalledProcessError as e:
+    except RuntimeError as e:
         logger.error(f"生成视频失败: {e}")
         return False
     finally:
         # 清理临时文件
         Path(temp_file.name).unlink(missing_ok=True)
-        temp_output.unlink(missing_ok=True)
 
 async def main():
     """主函数：将图片转换为视频"""
@@ -180,11 +282,11 @@ async def main():
     # 使用日期作为输出文件名
     output_name = latest_dir.name
     
-    return create_news_video(json_path, images_dir, output_name, 
+    return await create_news_video(json_path, images_dir, output_name, 
                         output_dir=latest_dir,
-                        audio_dir=str(latest_dir))
+                        audio_dir=str(latest_dir),
+                        fps=get_video_fps())
 
 if __name__ == "__main__":
-    import asyncio
     success = asyncio.run(main())
     sys.exit(0 if success else 1)
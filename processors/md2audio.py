@@ -1,3 +1,4 @@
+import asyncio
 import sys
 import os
 from pathlib import Path
@@ -10,8 +11,10 @@ sys.path.append(str(project_root))
 import re
 import logging
 import json
-from datetime import timedelta, date
-from pydub import AudioSegment
+import subprocess
+import tempfile
+from datetime import date
+from mutagen.mp3 import MP3
 from utils.text2audio import generate_audio
 
 # 确保logs目录存在
@@ -27,16 +30,69 @@ logging.basicConfig(
     ]
 )
 
+# 预编译文本预处理用到的正则表达式
+_RE_LINK = re.compile(r'\[(.*?)\][ ]*\(.*?\)')
+_RE_OBSIDIAN_IMG = re.compile(r'!\[\[.*?\]\]')
+_RE_MD_IMG = re.compile(r'!\[.*?\][ ]*\(.*?\)')
+_RE_DOT = re.compile(r'([.])(?=\s|$)')
+_RE_WS = re.compile(r'\s+')
+_RE_QUOTED = re.compile(r'"([^"]*)"')
+
+# 静音文件缓存目录，与生成结果放在项目自己的缓存目录下
+_SILENCE_CACHE_DIR = Path("output") / "cache" / "silence"
+
+# 单字符替换表：'-'替换为空格，未配对的英文双引号转换为中文左引号
+_TRANS = str.maketrans({'-': ' ', '"': '“'})
+
 def format_time(milliseconds):
     """将毫秒转换为SRT格式的时间字符串 (HH:MM:SS,mmm)"""
-    td = timedelta(milliseconds=milliseconds)
-    hours, remainder = divmod(td.seconds, 3600)
-    minutes, seconds = divmod(remainder, 60)
-    return f"{hours:02}:{minutes:02}:{seconds:02},{milliseconds % 1000:03}"
+    hours, remainder = divmod(milliseconds, 3_600_000)
+    minutes, remainder = divmod(remainder, 60_000)
+    seconds, millis = divmod(remainder, 1000)
+    return f"{hours:02}:{minutes:02}:{seconds:02},{millis:03}"
+
+def generate_silence(output_path, duration=1000, sample_rate=44100, channels=1):
+    """生成指定时长的无声MP3文件（默认1秒）"""
+    cmd = ['ffmpeg', '-y', '-v', 'error', '-f', 'lavfi',
+           '-i', f'anullsrc=r={sample_rate}:cl={"mono" if channels == 1 else "stereo"}',
+           '-t', str(duration / 1000), '-c:a', 'libmp3lame', '-b:a', '128k', str(output_path)]
+    subprocess.run(cmd, check=True)
+    return Path(output_path)
+
+def get_silence_file(duration=1000, sample_rate=44100, channels=1):
+    """获取指定参数的静音MP3文件，同一组参数只生成一次，后续直接复用"""
+    silence_path = _SILENCE_CACHE_DIR / f"silence-{duration}ms-{sample_rate}-{channels}.mp3"
+    if not silence_path.exists():
+        _SILENCE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        # 先写入临时文件再重命名，避免中断时留下不完整的缓存
+        partial_path = silence_path.with_name(f"{silence_path.stem}.{os.getpid()}.mp3")
+        try:
+            generate_silence(partial_path, duration, sample_rate, channels)
+            partial_path.replace(silence_path)
+        finally:
+            partial_path.unlink(missing_ok=True)
+    return silence_path
 
-def generate_silence(duration=1000):
-    """生成指定时长的无声音频（默认1秒）"""
-    return AudioSegment.silent(duration=duration)  # 确保精确指定毫秒
+def get_audio_duration_ms(audio_path):
+    """读取MP3文件头获取时长（毫秒），无需解码音频"""
+    return round(MP3(audio_path).info.length * 1000)
+
+def get_audio_params(audio_path):
+    """读取MP3文件的采样率和声道数"""
+    info = MP3(audio_path).info
+    return info.sample_rate, info.channels
+
+def concat_audio_files(audio_files, output_path):
+    """使用ffmpeg的concat demuxer一次性拼接并编码所有音频"""
+    with tempfile.NamedTemporaryFile(mode='w', suffix='.txt', delete=False, encoding='utf-8') as list_file:
+        list_file.write("".join(f"file '{Path(f).resolve()}'\n" for f in audio_files))
+    
+    try:
+        cmd = ['ffmpeg', '-y', '-v', 'error', '-f', 'concat', '-safe', '0', '-i', list_file.name,
+               '-c:a', 'libmp3lame', '-b:a', '128k', str(output_path)]
+        subprocess.run(cmd, check=True)
+    finally:
+        Path(list_file.name).unlink(missing_ok=True)
 
 def preprocess_text(text):
     """预处理文本，处理链接和图片等Markdown元素"""
@@ -44,27 +100,24 @@ def preprocess_text(text):
     
     # 处理链接 [文本](链接) -> 文本
     # 匹配 Markdown 链接，包括带空格的格式
-    text = re.sub(r'\[(.*?)\][ ]*\(.*?\)', r'\1', text)
+    text = _RE_LINK.sub(r'\1', text)
     logging.debug(f"处理链接后: {text[:100]}..." if len(text) > 100 else f"处理链接后: {text}")
     
     # 处理 Obsidian 格式图片，完全移除 ![[图片.png]]
-    text = re.sub(r'!\[\[.*?\]\]', '', text)
+    text = _RE_OBSIDIAN_IMG.sub('', text)
     
     # 处理标准 Markdown 格式图片，完全移除 ![alt](url)
-    text = re.sub(r'!\[.*?\][ ]*\(.*?\)', '', text)
+    text = _RE_MD_IMG.sub('', text)
     logging.debug(f"处理图片后: {text[:100]}..." if len(text) > 100 else f"处理图片后: {text}")
     
-    # 将'-'替换为空格
-    text = text.replace('-', ' ')
-    
-    # 将英文双引号转换为中文双引号
-    text = text.replace('"', '“').replace('"', '”')
+    # 成对的英文双引号转换为中文左右引号，其余单字符替换一次完成
+    text = _RE_QUOTED.sub(r'“\1”', text).translate(_TRANS)
     
     # 处理英文句点，将其转换为中文句号
-    text = re.sub(r'([.])(?=\s|$)', '。', text)
+    text = _RE_DOT.sub('。', text)
     
     # 移除多余空白字符
-    text = re.sub(r'\s+', ' ', text).strip()
+    text = _RE_WS.sub(' ', text).strip()
     
     logging.debug(f"最终预处理结果: {text[:100]}..." if len(text) > 100 else f"最终预处理结果: {text}")
     
@@ -86,7 +139,31 @@ def save_timeline(timeline_data, current_date, output_dir):
         json.dump(data, f, ensure_ascii=False, indent=2)
     logging.info(f"时间轴数据已保存到: {timeline_path}")
 
-def parse_markdown_and_generate_audio(markdown_content):
+def synthesize_sentence(sentence, audio_path):
+    """合成单句语音并读取其时长（毫秒），读取失败时删除音频文件"""
+    generate_audio(sentence, str(audio_path))
+    try:
+        return get_audio_duration_ms(audio_path)
+    except Exception as e:
+        logging.error(f"读取音频文件时出错: {e}")
+        Path(audio_path).unlink(missing_ok=True)
+        raise
+
+async def generate_audio_batch(jobs, concurrency=8):
+    """并发合成多段语音，返回与jobs顺序一致的时长列表（毫秒，失败项为异常对象）"""
+    semaphore = asyncio.Semaphore(concurrency)  # 限制并发数，避免压垮TTS服务
+    
+    async def worker(sentence, audio_path):
+        async with semaphore:
+            logging.info(f"生成音频: {audio_path}")
+            logging.debug(f"音频文本: {sentence}")
+            # 在同一工作线程里读取时长，与其他句子的TTS请求重叠进行
+            return await asyncio.to_thread(synthesize_sentence, sentence, audio_path)
+    
+    return await asyncio.gather(*[worker(sentence, audio_path) for sentence, audio_path in jobs],
+                                return_exceptions=True)
+
+async def parse_markdown_and_generate_audio(markdown_content):
     """解析Markdown内容，提取标题和文本，生成语音和字幕"""
     logging.info("开始解析Markdown内容")
     
@@ -112,15 +189,9 @@ def parse_markdown_and_generate_audio(markdown_content):
     sections = re.findall(r'##\s+(.*?)(?=\n##|\Z)', markdown_content, re.DOTALL)
     logging.info(f"找到 {len(sections)} 个章节")
     
-    # 生成SRT文件内容
-    srt_content = []
-    current_time = 0
-    sentence_index = 1
-    
-    # 创建一个合并的音频文件
-    combined_audio = AudioSegment.empty()
-    
-    # 处理所有章节
+    # 第一遍：拆分章节和句子，规划所有需要合成的语音
+    section_plans = []
+    tts_jobs = []
     for section_idx, section in enumerate(sections):
         logging.info(f"处理章节 {section_idx+1}/{len(sections)}")
         
@@ -161,81 +232,83 @@ def parse_markdown_and_generate_audio(markdown_content):
         complete_sentences = [s.strip() for s in complete_sentences if s.strip()]
         logging.info(f"过滤后句子数量: {len(complete_sentences)}")
         
+        # 生成安全的文件名，带上章节序号避免同名章节的临时文件冲突
+        safe_title = sanitize_filename(title)
+        sentence_jobs = []
+        for i, sentence in enumerate(complete_sentences, 1):
+            audio_path = output_dir / f"temp-{section_idx+1}-{safe_title}-{i}.mp3"
+            sentence_jobs.append((len(tts_jobs), sentence, audio_path))
+            tts_jobs.append((sentence, audio_path))
+        
+        section_plans.append((section_idx, title, sentence_jobs))
+    
+    # 并发合成所有句子的语音
+    logging.info(f"开始并发生成 {len(tts_jobs)} 段音频")
+    tts_results = await generate_audio_batch(tts_jobs)
+    
+    # 生成句间和章节间停顿用的静音文件，参数与合成的语音保持一致；ffmpeg在工作线程中运行，不阻塞事件循环
+    first_audio = next((path for (_, path), result in zip(tts_jobs, tts_results)
+                        if not isinstance(result, Exception) and path.exists()), None)
+    sample_rate, channels = get_audio_params(first_audio) if first_audio else (44100, 1)
+    short_silence_path = await asyncio.to_thread(get_silence_file, 300, sample_rate, channels)
+    silence_path = await asyncio.to_thread(get_silence_file, 1000, sample_rate, channels)
+    short_silence_duration = get_audio_duration_ms(short_silence_path)
+    silence_duration = get_audio_duration_ms(silence_path)
+    temp_files = []
+    
+    # 第二遍：按时间轴顺序计算字幕时间，并生成待拼接的文件列表
+    srt_content = []
+    concat_files = []
+    current_time = 0
+    sentence_index = 1
+    
+    for section_idx, title, sentence_jobs in section_plans:
         # 记录章节开始时间
         section_start_time = format_time(current_time)
         
         # 处理每个句子
-        for i, sentence in enumerate(complete_sentences, 1):
-            logging.info(f"处理句子 {i}/{len(complete_sentences)}")
+        for i, (job_idx, sentence, audio_path) in enumerate(sentence_jobs, 1):
+            logging.info(f"处理句子 {i}/{len(sentence_jobs)}")
             logging.debug(f"处理后的句子: {sentence}")
             
             try:
-                # 如果句子为空，跳过
-                if not sentence.strip():
-                    logging.warning(f"句子为空，跳过")
+                duration = tts_results[job_idx]  # 毫秒
+                if isinstance(duration, Exception):
+                    logging.error(f"生成音频时出错: {duration}")
                     continue
+                logging.info(f"音频时长: {duration}毫秒")
                 
-                # 生成安全的文件名
-                safe_title = sanitize_filename(title)
-                audio_path = output_dir / f"temp-{safe_title}-{i}.mp3"
-                
-                logging.info(f"生成音频: {audio_path}")
-                logging.debug(f"音频文本: {sentence}")
-                
-                try:
-                    generate_audio(sentence, str(audio_path))
-                    logging.info("音频生成成功")
-                except Exception as e:
-                    logging.error(f"生成音频时出错: {e}")
-                    continue
-                
-                # 获取音频时长
-                try:
-                    audio = AudioSegment.from_file(audio_path)
-                    duration = len(audio)  # 毫秒
-                    logging.info(f"音频时长: {duration}毫秒")
-                except Exception as e:
-                    logging.error(f"读取音频文件时出错: {e}")
-                    if os.path.exists(audio_path):
-                        os.remove(audio_path)
-                    continue
-                
-                # 添加到合并音频
-                combined_audio += audio
+                # 添加到待拼接列表，临时音频在拼接完成后统一删除
+                concat_files.append(audio_path)
+                temp_files.append(audio_path)
                 
                 # 添加到SRT内容
-                start_time = current_time
                 end_time = current_time + duration
+                start_ts = format_time(current_time)
+                end_ts = format_time(end_time)
                 
-                srt_content.append(f"{sentence_index}\n{format_time(start_time)} --> {format_time(end_time)}\n{sentence}\n")
-                logging.debug(f"添加字幕: {sentence_index}, {format_time(start_time)} --> {format_time(end_time)}")
+                srt_content.append(f"{sentence_index}\n{start_ts} --> {end_ts}\n{sentence}\n")
+                logging.debug(f"添加字幕: {sentence_index}, {start_ts} --> {end_ts}")
                 
                 current_time = end_time
                 sentence_index += 1
                 
-                # 删除临时音频文件
-                os.remove(audio_path)
-                logging.debug("删除临时音频文件")
-                
                 # 如果不是本章节的最后一个句子，则在句子之间添加0.3秒的停顿
-                if i < len(complete_sentences):
-                    # 添加0.3秒的无声
-                    short_silence = generate_silence(300)  # 300毫秒 = 0.3秒
-                    combined_audio += short_silence
+                if i < len(sentence_jobs):
+                    concat_files.append(short_silence_path)
                     
                     # 更新时间，但不添加字幕
-                    current_time += 300
-                    logging.debug("添加短暂停顿: 300毫秒")
+                    current_time += short_silence_duration
+                    logging.debug(f"添加短暂停顿: {short_silence_duration}毫秒")
             except Exception as e:
                 logging.error(f"处理句子时出错: {e}")
                 continue
             
         # 如果不是最后一个章节，添加1秒钟的无声音频
         if section_idx < len(sections) - 1:
-            silence = generate_silence()
-            combined_audio += silence
-            current_time += 1000
-            logging.debug("章节之间添加停顿: 1000毫秒")
+            concat_files.append(silence_path)
+            current_time += silence_duration
+            logging.debug(f"章节之间添加停顿: {silence_duration}毫秒")
             
         # 添加到时间轴 - 使用不同的结束时间逻辑
         if section_idx == len(sections) - 1:
@@ -255,10 +328,16 @@ def parse_markdown_and_generate_audio(markdown_content):
     try:
         combined_audio_path = output_dir / f"audio_{current_date}.mp3"
         logging.info(f"保存合并音频文件: {combined_audio_path}")
-        combined_audio.export(str(combined_audio_path), format="mp3")
+        # 整段旁白的编码耗时较长，放到工作线程中执行
+        await asyncio.to_thread(concat_audio_files, concat_files, combined_audio_path)
         logging.info("音频文件保存成功")
     except Exception as e:
         logging.error(f"保存合并音频文件时出错: {e}")
+    finally:
+        # 删除临时音频文件
+        for temp_file in temp_files:
+            Path(temp_file).unlink(missing_ok=True)
+        logging.debug("删除临时音频文件")
     
     # 写入单个SRT文件
     try:
@@ -282,7 +361,7 @@ def parse_markdown_and_generate_audio(markdown_content):
     print(f"已生成时间轴文件: {output_dir / f'timeline_{current_date}.json'}")
     print(f"共处理了 {sentence_index-1} 个句子")
 
-def process_markdown_file(file_path):
+async def process_markdown_file(file_path):
     """处理Markdown文件"""
     logging.info(f"开始处理Markdown文件: {file_path}")
     
@@ -294,7 +373,7 @@ def process_markdown_file(file_path):
         logging.error(f"读取文件时出错: {e}")
         return
     
-    parse_markdown_and_generate_audio(markdown_content)
+    await parse_markdown_and_generate_audio(markdown_content)
 
 if __name__ == "__main__":
     # 示例使用
@@ -320,4 +399,4 @@ if __name__ == "__main__":
         
         print(f"已创建示例Markdown文件: {markdown_file}")
     
-    process_markdown_file(markdown_file)
+    asyncio.run(process_markdown_file(markdown_file))
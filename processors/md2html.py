@@ -1,5 +1,7 @@
 """Convert markdown to HTML with timeline support."""
 import asyncio
+import functools
+import hashlib
 import json
 import re
 import sys
@@ -7,8 +9,10 @@ import argparse
 import yaml
 import os
 import logging
+import random
 from pathlib import Path
-from openai import AsyncOpenAI
+from typing import Optional
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 from dotenv import load_dotenv
 from datetime import datetime
 
@@ -21,55 +25,55 @@ load_dotenv()
 
 # 导入公共模块
 from utils.paths import get_output_dir
+from utils.aio import run
 
-# 确保logs目录存在
-Path("logs").mkdir(exist_ok=True)
-
-# 初始化日志
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler(f"logs/{datetime.now().strftime('%Y%m%d_%H%M%S')}_md2html.log")
-    ]
-)
 logger = logging.getLogger(__name__)
 
+def _setup_logging():
+    """初始化日志（仅在直接运行本模块时调用，被导入时不创建日志文件）"""
+    # 确保logs目录存在
+    Path("logs").mkdir(exist_ok=True)
+    
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.StreamHandler(),
+            logging.FileHandler(f"logs/{datetime.now().strftime('%Y%m%d_%H%M%S')}_md2html.log")
+        ]
+    )
+
 # 添加父目录到Python路径
 sys.path.append(str(Path(__file__).parent))
 
-async def read_file_content(file_path: Path) -> str:
-    """读取文件内容"""
-    try:
-        return file_path.read_text(encoding='utf-8')
-    except Exception as e:
-        logger.error(f"无法读取文件 {file_path}: {e}")
-        raise
-
-def parse_markdown_content(content: str) -> list:
-    """解析Markdown内容为新闻条目列表"""
-    # 移除分隔符
-    content = re.sub(r'---+', '', content)
-    
-    if not content.strip().startswith('##'):
-        if '##' in content:
-            content = f"## AI 行业早报\n{content.split('##')[0]}\n##" + '##'.join(content.split('##')[1:])
-        else:
-            content = f"## AI 行业早报\n{content}"
-    
-    sections = re.split(r'(?m)^##\s+', content)
-    return [section.strip() for section in sections if section.strip()]
+# 预编译解析新闻内容用到的正则表达式
+_RE_SEP = re.compile(r'---+')
+_RE_SPLIT_H2 = re.compile(r'^##\s+', re.MULTILINE)
+_RE_LEADING_H2 = re.compile(r'\s*##')
+_RE_FENCE_OPEN = re.compile(r'```[A-Za-z0-9_-]*')
 
-async def save_html_page(html_content: str, file_path: Path):
-    """保存HTML页面"""
-    file_path.parent.mkdir(parents=True, exist_ok=True)
-    file_path.write_text(html_content, encoding='utf-8')
-    logger.info(f"已保存HTML页面到 {file_path}")
+# LLM生成失败时使用的默认页面模板
+_DEFAULT_TMPL = """<!DOCTYPE html>
+<html lang="zh-CN">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>{title}</title>
+    <style>
+        body {{ font-family: 'Microsoft YaHei', Arial, sans-serif; line-height: 1.6; color: #333; max-width: 800px; margin: 0 auto; padding: 20px; }}
+        h1 {{ color: #2c3e50; border-bottom: 2px solid #eee; padding-bottom: 10px; }}
+        p {{ margin-bottom: 15px; }}
+        @media (max-width: 768px) {{ body {{ padding: 15px; }} }}
+    </style>
+</head>
+<body>
+    <h1>{title}</h1>
+    <div>{body}</div>
+</body>
+</html>"""
 
-async def create_index_page(titles: list, file_paths: list, output_dir: Path):
-    """创建索引页面"""
-    index_content = """<!DOCTYPE html>
+# 索引页面的头部、每条新闻的链接模板和尾部
+_INDEX_HEADER = """<!DOCTYPE html>
 <html lang="zh-CN">
 <head>
     <meta charset="UTF-8">
@@ -88,87 +92,296 @@ async def create_index_page(titles: list, file_paths: list, output_dir: Path):
     <h1>AI新闻页面索引</h1>
     <ul>
 """
+
+_INDEX_ITEM = '        <li><a href="{href}" target="_blank">{title}</a></li>\n'
+_INDEX_FOOTER = """    </ul>
+</body>
+</html>"""
+
+# 优先使用libyaml的C实现解析YAML
+_YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+@functools.lru_cache(maxsize=1)
+def _load_config(path: str = 'llmConfig.yaml') -> dict:
+    """读取并缓存LLM配置文件，同一进程内只解析一次"""
+    return yaml.load(Path(path).read_bytes(), Loader=_YamlLoader)
+
+async def read_file_content(file_path: Path) -> str:
+    """读取文件内容"""
+    try:
+        # 在工作线程中读取并解码字节，统一换行符，避免\r混入提示词、缓存键和默认模板
+        return await asyncio.to_thread(
+            lambda: file_path.read_bytes().decode('utf-8').replace('\r\n', '\n'))
+    except Exception as e:
+        logger.error("无法读取文件 %s: %s", file_path, e)
+        raise
+
+def parse_markdown_content(content: str) -> list[tuple[str, str]]:
+    """解析Markdown内容为 (标题, 正文) 形式的新闻条目列表"""
+    # 移除分隔符
+    content = _RE_SEP.sub('', content)
+    
+    # 检查开头是否为 ## 标题，无需复制整篇内容做strip
+    if not _RE_LEADING_H2.match(content):
+        idx = content.find('##')
+        if idx != -1:
+            # 开头的引言单独成为一节，并确保第一个 ## 位于行首
+            content = f"## AI 行业早报\n{content[:idx]}\n{content[idx:]}"
+        else:
+            content = f"## AI 行业早报\n{content}"
+    
+    # 分割时已去掉 "## " 前缀，每节第一行就是标题
+    result = []
+    for section in _RE_SPLIT_H2.split(content):
+        section = section.strip()
+        if not section:
+            continue
+        title, _, body = section.partition('\n')
+        result.append((title.strip(), body))
+    return result
+
+async def save_html_page(html_content: str, file_path: Path):
+    """保存HTML页面"""
+    await asyncio.to_thread(file_path.parent.mkdir, parents=True, exist_ok=True)
+    await asyncio.to_thread(file_path.write_text, html_content, encoding='utf-8')
+    logger.info("已保存HTML页面到 %s", file_path)
+
+async def create_index_page(titles: list, file_paths: list, output_dir: Path):
+    """创建索引页面"""
+    body = []
     for i, (title, file_path) in enumerate(zip(titles, file_paths)):
         rel_path = file_path.relative_to(output_dir)
         clean_title = title.replace('##', '').strip() or f"新闻 {i+1}"
-        index_content += f'        <li><a href="{rel_path}" target="_blank">{clean_title}</a></li>\n'
-    
-    index_content += """    </ul>
-</body>
-</html>"""
+        body.append(_INDEX_ITEM.format(href=rel_path, title=clean_title))
+    index_content = _INDEX_HEADER + ''.join(body) + _INDEX_FOOTER
     
     index_path = output_dir / "index.html"
-    index_path.write_text(index_content, encoding='utf-8')
-    logger.info(f"已保存索引页面到 {index_path}")
+    await asyncio.to_thread(index_path.write_text, index_content, encoding='utf-8')
+    logger.info("已保存索引页面到 %s", index_path)
+
+async def stream_completion(client: AsyncOpenAI, completion_params: dict, idle_timeout: float) -> str:
+    """以流式方式请求补全并拼接结果，两个数据块之间超过idle_timeout秒视为超时"""
+    stream = await asyncio.wait_for(
+        client.chat.completions.create(**completion_params, stream=True), timeout=idle_timeout)
+    chunks = []
+    try:
+        iterator = stream.__aiter__()
+        while True:
+            try:
+                chunk = await asyncio.wait_for(iterator.__anext__(), timeout=idle_timeout)
+            except StopAsyncIteration:
+                break
+            if chunk.choices and chunk.choices[0].delta.content:
+                chunks.append(chunk.choices[0].delta.content)
+    finally:
+        await stream.close()
+    return ''.join(chunks)
+
+def build_completion_params(model: str, system_prompt: str, news_content: str, max_tokens: int = 4000) -> dict:
+    """构建生成新闻HTML的请求参数"""
+    return {
+        "model": model,
+        "temperature": 0.7,  # 直接在API调用时设置temperature
+        "max_tokens": max_tokens,  # 设置最大token数
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": f"以下为新闻文章的内容：\n{news_content}"}
+        ]
+    }
+
+def extract_html(response: str) -> Optional[str]:
+    """从模型输出中提取HTML，不是有效的HTML时返回None"""
+    clean_response = response.strip()
+    
+    # 去掉代码块标记，开头可能带任意语言标签（如 ```html）
+    fence = _RE_FENCE_OPEN.match(clean_response)
+    if fence:
+        rest = clean_response[fence.end():]
+        if rest.lstrip(" \t").startswith("<"):
+            # 标签后紧跟HTML（如 ```html<!DOCTYPE html>），只去掉标记和语言标签
+            clean_response = rest
+        else:
+            nl = clean_response.find("\n")
+            clean_response = clean_response[nl+1:] if nl != -1 else rest
+    # 结尾的代码块标记单独去掉，模型有时只在末尾多输出一个 ```
+    if clean_response.endswith("```"):
+        clean_response = clean_response[:-3]
+    clean_response = clean_response.strip()
+    
+    if not clean_response.startswith(("<!DOCTYPE", "<html")):
+        return None
+    return clean_response
+
+def get_cache_path(cache_dir: Path, model: str, system_prompt: str, news_content: str) -> Path:
+    """根据模型、提示词和新闻内容计算缓存文件路径"""
+    key = hashlib.blake2b(f"{model}\n{system_prompt}\n{news_content}".encode('utf-8'),
+                          digest_size=16).hexdigest()
+    return cache_dir / f"{key}.html"
+
+async def read_cache(cache_path: Path) -> Optional[str]:
+    """读取缓存的HTML，未命中时返回None"""
+    try:
+        if await asyncio.to_thread(cache_path.exists):
+            return await asyncio.to_thread(cache_path.read_text, encoding='utf-8')
+    except OSError as e:
+        logger.warning("读取缓存 %s 失败: %s", cache_path, e)
+    return None
 
-async def generate_html_for_news(news_content: str, client: AsyncOpenAI, system_prompt: str, index: int) -> str:
-    """为新闻生成HTML页面"""
-    logger.info(f"正在为新闻 {index+1} 生成HTML页面...")
+async def write_cache(cache_path: Path, html_content: str):
+    """写入HTML缓存，失败时只记录警告"""
+    try:
+        await asyncio.to_thread(cache_path.parent.mkdir, parents=True, exist_ok=True)
+        await asyncio.to_thread(cache_path.write_text, html_content, encoding='utf-8')
+    except OSError as e:
+        logger.warning("写入缓存 %s 失败: %s", cache_path, e)
+
+async def generate_html_for_news(news_content: str, client: AsyncOpenAI, system_prompt: str, index: int,
+                                 request_timeout: float = 30, max_tokens: int = 4000,
+                                 max_attempts: int = 3, response_timeout: float = 300,
+                                 cache_dir: Path = None) -> str:
+    """为新闻生成HTML页面，指定cache_dir时相同的模型、提示词和内容直接复用上次的结果"""
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = get_cache_path(cache_dir, client.model, system_prompt, news_content)
+        cached = await read_cache(cache_path)
+        if cached is not None:
+            logger.info("新闻 %d 命中缓存: %s", index + 1, cache_path)
+            return cached
+    
+    logger.info("正在为新闻 %d 生成HTML页面...", index + 1)
     
     try:
         # 准备请求参数
-        completion_params = {
-            "model": client.model,
-            "temperature": 0.7,  # 直接在API调用时设置temperature
-            "max_tokens": 4000,  # 设置最大token数
-            "messages": [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": f"以下为新闻文章的内容：\n{news_content}"}
-            ]
-        }
+        completion_params = build_completion_params(client.model, system_prompt, news_content, max_tokens)
         
-        response = await client.chat.completions.create(**completion_params)
-        clean_response = response.choices[0].message.content.strip()
+        # 请求卡住（超过request_timeout秒没有新数据）或整页超过response_timeout秒仍未生成完时退避重试，
+        # 避免拖慢整批生成；整页的时限要留足生成max_tokens个token的时间
+        response = None
+        for attempt in range(max_attempts):
+            try:
+                response = await asyncio.wait_for(
+                    stream_completion(client, completion_params, request_timeout), timeout=response_timeout)
+                break
+            except asyncio.TimeoutError:
+                logger.warning("新闻 %d 请求超时（第 %d/%d 次）", index + 1, attempt + 1, max_attempts)
+                if attempt + 1 < max_attempts:
+                    await asyncio.sleep(random.uniform(2, 4) * (attempt + 1))
         
-        if clean_response.startswith("```html"):
-            clean_response = clean_response[7:]
-        elif clean_response.startswith("```"):
-            clean_response = clean_response[3:]
-        
-        if clean_response.endswith("```"):
-            clean_response = clean_response[:-3]
+        if response is None:
+            logger.error("新闻 %d 多次请求超时，使用默认模板", index + 1)
+            return generate_default_html(news_content, index)
         
-        if not clean_response.startswith(("<!DOCTYPE", "<html")):
+        html_content = extract_html(response)
+        if html_content is None:
             logger.warning("返回的内容不是有效的HTML，使用默认模板")
             return generate_default_html(news_content, index)
         
-        return clean_response.strip()
+        # 只缓存模型生成的有效HTML，默认模板不缓存
+        if cache_path is not None:
+            await write_cache(cache_path, html_content)
+        
+        return html_content
     except Exception as e:
-        logger.error(f"生成HTML时发生错误: {e}")
+        logger.error("生成HTML时发生错误: %s", e)
         return generate_default_html(news_content, index)
 
+async def generate_html_batch(news_contents: list, client: AsyncOpenAI, system_prompt: str,
+                              max_tokens: int = 4000, cache_dir: Path = None,
+                              completion_window: str = "24h") -> list:
+    """通过Batch API离线批量生成HTML，返回与news_contents顺序一致的HTML列表
+    
+    适合不在意延迟的定时任务：所有请求一次性提交，等待批处理完成后统一取回结果。
+    """
+    htmls = [None] * len(news_contents)
+    
+    # 先查缓存，只提交未命中的新闻
+    cache_paths = [None] * len(news_contents)
+    if cache_dir is not None:
+        for i, news_content in enumerate(news_contents):
+            cache_paths[i] = get_cache_path(cache_dir, client.model, system_prompt, news_content)
+            htmls[i] = await read_cache(cache_paths[i])
+            if htmls[i] is not None:
+                logger.info("新闻 %d 命中缓存: %s", i + 1, cache_paths[i])
+    
+    pending = [i for i, html_content in enumerate(htmls) if html_content is None]
+    if pending:
+        try:
+            # 构建批处理输入文件，每行一个请求
+            lines = [json.dumps({
+                "custom_id": f"news_{i}",
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": build_completion_params(client.model, system_prompt, news_contents[i], max_tokens)
+            }, ensure_ascii=False) for i in pending]
+            batch_input = await client.files.create(
+                file=("batch_input.jsonl", "\n".join(lines).encode('utf-8')), purpose="batch")
+            batch = await client.batches.create(
+                input_file_id=batch_input.id, endpoint="/v1/chat/completions",
+                completion_window=completion_window)
+            logger.info("已提交批处理任务 %s，共 %d 条新闻", batch.id, len(pending))
+            
+            # 指数退避轮询，直到批处理结束
+            delay = 5
+            while batch.status not in ("completed", "failed", "expired", "cancelled"):
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 300)
+                batch = await client.batches.retrieve(batch.id)
+                logger.info("批处理任务 %s 状态: %s", batch.id, batch.status)
+            
+            if batch.status == "completed" and batch.output_file_id:
+                output = await client.files.content(batch.output_file_id)
+                for line in output.text.splitlines():
+                    if not line.strip():
+                        continue
+                    # 单条结果解析失败只影响该条新闻，其余结果照常使用
+                    try:
+                        item = json.loads(line)
+                        i = int(item["custom_id"].split("_")[1])
+                        if not 0 <= i < len(htmls):
+                            raise ValueError(f"无效的custom_id: {item['custom_id']}")
+                        response = item.get("response") or {}
+                        if response.get("status_code") != 200:
+                            logger.warning("新闻 %d 批处理失败: %s", i + 1, item.get("error"))
+                            continue
+                        content = response["body"]["choices"][0]["message"]["content"]
+                    except (AttributeError, KeyError, IndexError, TypeError, ValueError) as e:
+                        logger.warning("无法解析批处理结果 %r: %s", line[:200], e)
+                        continue
+                    html_content = extract_html(content) if content is not None else None
+                    if html_content is None:
+                        logger.warning("新闻 %d 返回的内容不是有效的HTML，使用默认模板", i + 1)
+                        continue
+                    htmls[i] = html_content
+                    if cache_paths[i] is not None:
+                        await write_cache(cache_paths[i], html_content)
+            else:
+                logger.error("批处理任务 %s 未完成: %s", batch.id, batch.status)
+        except Exception as e:
+            logger.error("批处理生成HTML时发生错误: %s", e)
+    
+    # 没有拿到结果的新闻使用默认模板
+    return [html_content if html_content is not None else generate_default_html(news_contents[i], i)
+            for i, html_content in enumerate(htmls)]
+
 def generate_default_html(news_content: str, index: int) -> str:
     """生成默认HTML模板"""
-    lines = news_content.strip().split('\n')
-    title = lines[0].replace('##', '').strip() if lines else f"新闻 {index+1}"
-    content = '\n'.join(lines[1:]) if len(lines) > 1 else ""
+    first, _, content = news_content.strip().partition('\n')
+    title = first.replace('##', '').strip() or f"新闻 {index+1}"
     
-    return f"""<!DOCTYPE html>
-<html lang="zh-CN">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>{title}</title>
-    <style>
-        body {{ font-family: 'Microsoft YaHei', Arial, sans-serif; line-height: 1.6; color: #333; max-width: 800px; margin: 0 auto; padding: 20px; }}
-        h1 {{ color: #2c3e50; border-bottom: 2px solid #eee; padding-bottom: 10px; }}
-        p {{ margin-bottom: 15px; }}
-        @media (max-width: 768px) {{ body {{ padding: 15px; }} }}
-    </style>
-</head>
-<body>
-    <h1>{title}</h1>
-    <div>{content.replace('\n', '<br>')}</div>
-</body>
-</html>"""
+    body = content.replace('\n', '<br>')
+    return _DEFAULT_TMPL.format(title=title, body=body)
 
 async def main():
     # 解析命令行参数
     parser = argparse.ArgumentParser(description="生成HTML静态页面")
     parser.add_argument("--output", "-o", default="html_pages", help="HTML页面输出目录")
     parser.add_argument("--content", "-c", default="newsText.md", help="内容文件路径")
+    parser.add_argument("--no-cache", action="store_true", help="不使用缓存，全部重新生成HTML")
+    parser.add_argument("--batch", action="store_true",
+                        help="使用Batch API离线批量生成（费用更低，但需要等待批处理完成）")
     args = parser.parse_args()
 
+    client = None
     try:
         # 获取标准输出目录
         output_dir = get_output_dir("html")
@@ -177,50 +390,75 @@ async def main():
         md_content = await read_file_content(Path(args.content))
         
         # 读取配置文件
-        with open('llmConfig.yaml', 'r', encoding='utf-8') as f:
-            config = yaml.safe_load(f)
-            md2html_config = config['md2html']
+        md2html_config = _load_config()['md2html']
         
         # 从环境变量获取 API key
         api_key = os.getenv('LLM_API_KEY')
         if not api_key:
             raise ValueError("未找到环境变量 LLM_API_KEY，请在 .env 文件中设置")
         
-        # 创建OpenAI客户端
+        # 创建OpenAI客户端，所有并发请求共用一个HTTP/2连接池
+        # 基于SDK的默认httpx客户端，保留其连接数上限、重定向等默认设置，超时统一由AsyncOpenAI设置
+        http_client = DefaultAsyncHttpxClient(http2=True)
         client = AsyncOpenAI(
             base_url=md2html_config['base_url'],
             api_key=api_key,
             timeout=60.0,  # 设置超时时间
-            max_retries=3  # 设置最大重试次数
+            max_retries=3,  # 设置最大重试次数
+            http_client=http_client
         )
         # 设置模型名称
         client.model = md2html_config['name']
         
         # 解析内容
         news_items = parse_markdown_content(md_content)
-        logger.info(f"共解析出 {len(news_items)} 条新闻")
+        logger.info("共解析出 %d 条新闻", len(news_items))
+        
+        titles = [f"## {title or f'新闻 {i+1}'}" for i, (title, _) in enumerate(news_items)]
+        
+        # 相同内容的HTML缓存目录
+        cache_dir = None if args.no_cache else Path(md2html_config.get("cache_dir", "output/cache/html"))
         
-        # 处理每条新闻
-        file_paths = []
-        titles = []
-        for i, news_item in enumerate(news_items):
-            title_match = re.search(r'^## (.+?)(\n|$)', news_item)
-            title = f"## {title_match.group(1).strip()}" if title_match else f"## 新闻 {i+1}"
-            titles.append(title)
+        news_contents = [f"{title}\n{body}" for title, body in news_items]
+        if args.batch:
+            # 离线批量生成
+            htmls = await generate_html_batch(
+                news_contents, client, md2html_config['system_prompt'],
+                max_tokens=md2html_config.get("max_tokens", 4000),
+                cache_dir=cache_dir)
+        else:
+            # 并发生成所有新闻的HTML，用信号量限制同时进行的请求数
+            semaphore = asyncio.Semaphore(md2html_config.get("concurrency", 10))
+            
+            async def worker(i, news_content):
+                async with semaphore:
+                    return await generate_html_for_news(
+                        news_content, client, md2html_config['system_prompt'], i,
+                        request_timeout=md2html_config.get("request_timeout", 30),
+                        response_timeout=md2html_config.get("response_timeout", 300),
+                        max_tokens=md2html_config.get("max_tokens", 4000),
+                        cache_dir=cache_dir)
             
-            # 生成并保存HTML
-            html_content = await generate_html_for_news(news_item, client, md2html_config['system_prompt'], i)
-            file_path = output_dir / f"news_{i+1}.html"
-            await save_html_page(html_content, file_path)
-            file_paths.append(file_path)
+            htmls = await asyncio.gather(*[worker(i, news_content)
+                                           for i, news_content in enumerate(news_contents)])
+        
+        # 保存HTML
+        file_paths = [output_dir / f"news_{i+1}.html" for i in range(len(htmls))]
+        await asyncio.gather(*[save_html_page(html_content, file_path)
+                               for html_content, file_path in zip(htmls, file_paths)])
         
         # 创建索引
         await create_index_page(titles, file_paths, output_dir)
                
         logger.info("处理完成！")
     except Exception as e:
-        logger.error(f"处理失败: {e}")
+        logger.error("处理失败: %s", e)
         raise
+    finally:
+        # 关闭客户端及其连接池
+        if client is not None:
+            await client.close()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    _setup_logging()
+    run(main())
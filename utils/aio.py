@@ -0,0 +1,20 @@
+"""Asyncio helpers for md2video package."""
+import asyncio
+
+def run(main):
+    """Run a coroutine to completion, on uvloop when it is installed.
+    
+    uvloop is not available on Windows; there the default asyncio event
+    loop is used.
+    
+    Args:
+        main: Coroutine to run (e.g. main())
+    
+    Returns:
+        The coroutine's return value
+    """
+    try:
+        import uvloop
+    except ImportError:
+        return asyncio.run(main)
+    return uvloop.run(main)